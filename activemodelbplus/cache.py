@@ -29,7 +29,9 @@ class DiskCache:
             f.write(cloudpickle.dumps(self.cache))
 
     def __call__(self, *args, **kwargs):
-        signature = (args, tuple(sorted(kwargs.items())))
+        # Arguments can define how they are identified in the cache through a disk_cache_key
+        # attribute, e.g. so that cached results are invalidated when their definition changes.
+        signature = (tuple(getattr(a, 'disk_cache_key', a) for a in args), tuple(sorted(kwargs.items())))
         key = cloudpickle.dumps(signature)
         if key in self.cache:
             return self.cache[key]
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+import sys, os, inspect, hashlib, tempfile
+import importlib.util
+import numpy as np
+import sympy as sp
+from sympy.printing.numpy import NumPyPrinter
+
+from .cache import cachedir
+
+# numba is an optional dependency: if it is available we compile the numerical functions
+# generated by sympy into machine code, otherwise we fall back to slower backends.
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# symengine is another optional dependency, which can compile expressions with LLVM.
+try:
+    import symengine
+except ImportError:
+    symengine = None
+
+# Version of the format of the compiled objects (e.g. the pickled state of ElementKernel, or what
+# the compiled_* methods of problems return) which are cached to the disk. This must be
+# incremented whenever that format changes, so that incompatible cached objects are not loaded.
+compiled_format_version = 2
+
+def load_as_module(source, namespace):
+    """Write generated source code (e.g. from sp.lambdify) to a module in the cache directory
+    and import it from there.
+
+    numba can only cache compiled functions to the disk when their source lives in a real file,
+    which is not the case for the <lambdifygenerated> functions created by sympy.
+
+    Args:
+        source: source code of the module.
+        namespace: globals the generated code relies on.
+    Returns:
+        The imported module.
+    """
+    path = cachedir / 'jit' / ('lambdified_%s.py' % hashlib.sha1(source.encode()).hexdigest())
+    if not path.exists():
+        # Other processes may be generating the same module concurrently, so we write to a
+        # unique temporary file and atomically move it into place.
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=path.parent, suffix='.tmp', delete=False) as f:
+            f.write(source)
+        os.replace(f.name, path)
+
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    # numba needs to be able to import the module again when loading its cache.
+    sys.modules[spec.name] = module
+    module.__dict__.update({k: v for k, v in namespace.items() if not k.startswith('__')})
+    spec.loader.exec_module(module)
+    return module
+
+class JitFunction:
+    """A sympy expression compiled into a numerical function, which is just-in-time compiled
+    by numba where possible.
+
+    Functions generated by sp.lambdify are pure arithmetic on scalars and numpy arrays, so
+    numba can fuse the array operations into a single loop and remove the Python overhead of
+    each call. Compilation occasionally fails for expressions numba cannot lower, in which case
+    we permanently fall back to the function generated by sympy.
+    """
+
+    def __init__(self, arguments, expression):
+        """
+        Args:
+            arguments: symbols taken as arguments by the function (as for sp.lambdify).
+            expression: sympy expression (or matrix) to evaluate, or a list of expressions in
+                which case the function returns a tuple of their values (sharing common
+                subexpressions).
+        """
+        self.nargs = len(arguments)
+
+        # Rename arguments so the generated source does not depend on the names sympy gives
+        # to dummy variables, which change between sessions and would invalidate numba's cache.
+        # Rational coefficients are evaluated as floats so we do not generate integer arithmetic,
+        # and constants are made floats so matrix entries all have the same type.
+        placeholders = sp.symbols('arg0:%d' % self.nargs)
+        replacements = dict(zip(arguments, placeholders))
+        def prepare(e):
+            e = sp.sympify(e).evalf().xreplace(replacements)
+            return sp.Float(e) if e.is_Number else e
+        if isinstance(expression, (list, tuple)): expression = tuple(prepare(e) for e in expression)
+        elif isinstance(expression, sp.MatrixBase): expression = expression.applyfunc(prepare)
+        else: expression = prepare(expression)
+
+        # Common subexpressions (e.g. the interpolating polynomial evaluated at quadrature points)
+        # are hoisted into temporaries so they are only evaluated once per call.
+        self.function = sp.lambdify(placeholders, expression, cse=True, docstring_limit=0)
+        self.source = inspect.getsource(self.function)
+        self.compile()
+
+    def compile(self):
+        self.compiled = None
+        if numba is None: return
+
+        try:
+            # The generated source relies on the (numpy) namespace it was created in.
+            module = load_as_module(self.source, self.function.__globals__)
+            function = getattr(module, self.function.__name__)
+            self.compiled = numba.njit(fastmath=True, error_model='numpy', cache=True)(function)
+        except Exception as e: self.fallback(e)
+
+    def fallback(self, error):
+        sys.stderr.write('warning: numba could not compile %s (%s); falling back to numpy.\n' %
+                         (self.function.__name__, type(error).__name__))
+        self.compiled = None
+
+    # We only store the sympy-generated function when pickling (e.g. for caching to the disk),
+    # and recompile (or reload from numba's cache) when unpickling.
+    def __getstate__(self):
+        return {'nargs': self.nargs, 'function': self.function, 'source': self.source}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile()
+
+    def __call__(self, *args):
+        if self.compiled is not None:
+            # numba compiles lazily, so failures to lower the code (which do not always raise a
+            # NumbaError) only appear here.
+            try: return self.compiled(*args)
+            except Exception as e: self.fallback(e)
+        return self.function(*args)
+
+class ElementKernel:
+    """A list of sympy expressions compiled into a single kernel evaluating all of them on every
+    element of a mesh at once.
+
+    The kernel takes arguments with a value in each element or at each node of the mesh (e.g. the
+    node positions and weights, where each element takes the values at its left and right nodes)
+    and parameters shared by all elements, and writes the value of every expression into a row of
+    an output buffer for each element.
+    With numba the loop over elements is compiled and run in parallel, so each element's inputs
+    are only read once for all of the expressions. Without numba we use symengine's LLVM
+    Lambdify (which evaluates into the same buffer) if it is available, and otherwise the
+    numpy function generated by sympy.
+    """
+
+    backends = ['numba', 'symengine', 'numpy']
+
+    def __init__(self, arguments, expressions, parameters=[]):
+        """
+        Args:
+            arguments: arguments taking a different value in each element. Each entry is either
+                a symbol (for a scalar argument) or a list of symbols (for a vector argument), or
+                a tuple of these for the left and right nodes of an argument defined on the nodes.
+            expressions: list of sympy expressions to evaluate.
+            parameters: symbols for scalar parameters shared by all elements.
+        """
+        self.node_arguments = [isinstance(a, tuple) for a in arguments]
+        self.vector_arguments = [isinstance(a[0] if is_node else a, list)
+                                 for a, is_node in zip(arguments, self.node_arguments)]
+        # Shape of each argument's value in a single element (or node), used to validate inputs
+        # because the numba kernel does not check its indices.
+        self.argument_shapes = [(len(a[0] if is_node else a),) if is_vector else ()
+                                for a, is_node, is_vector in
+                                zip(arguments, self.node_arguments, self.vector_arguments)]
+        self.nparameters = len(parameters)
+        self.noutputs = len(expressions)
+        expressions = [sp.sympify(e).evalf() for e in expressions]
+
+        # Kernel arguments are named by their position, so the generated source does not
+        # depend on the names of sympy symbols. In the numba kernel each argument is indexed
+        # by the element (or its nodes), whereas the other backends take the (flattened)
+        # arguments directly.
+        element = sp.Symbol('e', integer=True)
+        indexed, flattened = {}, {}
+        for i, argument in enumerate(arguments):
+            array = sp.IndexedBase('arg%d' % i)
+            sides = argument if self.node_arguments[i] else (argument,)
+            for side, symbols in enumerate(sides):
+                if not self.vector_arguments[i]: symbols = [symbols]
+                for j, a in enumerate(symbols):
+                    indexed[a] = array[element+side, j] if self.vector_arguments[i] else array[element+side]
+                    flattened[a] = sp.Symbol('arg%d_%d' % (i, len(flattened)))
+        shared = sp.IndexedBase('parameters')
+        indexed.update({p: shared[j] for j, p in enumerate(parameters)})
+        flattened.update({p: sp.Symbol('parameter%d' % j) for j, p in enumerate(parameters)})
+
+        self.source = self.generate_source([e.xreplace(indexed) for e in expressions])
+        self.symbols = list(flattened.values())
+        self.expressions = [e.xreplace(flattened) for e in expressions]
+        self.compile()
+
+    def generate_source(self, expressions):
+        printer = NumPyPrinter()
+        arguments = ['arg%d' % i for i in range(len(self.vector_arguments))]
+        lines = ['def kernel(%s, parameters, out):' % ', '.join(arguments),
+                 '    for e in prange(out.shape[0]):']
+
+        temporaries, expressions = sp.cse(expressions, symbols=sp.numbered_symbols('tmp'))
+        for symbol, expression in temporaries:
+            lines += ['        %s = %s' % (symbol, printer.doprint(expression))]
+        for i, expression in enumerate(expressions):
+            lines += ['        out[e, %d] = %s' % (i, printer.doprint(expression))]
+
+        return '\n'.join(lines) + '\n'
+
+    def compile(self, backends=None):
+        """Compile the kernel with the first of the backends that succeeds."""
+        if backends is None: backends = self.backends
+
+        for backend in backends:
+            try:
+                if backend == 'numba':
+                    if numba is None: continue
+                    module = load_as_module(self.source, {'numpy': np, 'prange': numba.prange})
+                    self.compiled = numba.njit(parallel=True, fastmath=True, error_model='numpy',
+                                               cache=True)(module.kernel)
+
+                elif backend == 'symengine':
+                    if symengine is None: continue
+                    arguments = [symengine.sympify(s) for s in self.symbols]
+                    expressions = [symengine.sympify(e) for e in self.expressions]
+                    try:
+                        self.compiled = symengine.Lambdify(arguments, expressions, real=True,
+                                                           backend='llvm', cse=True)
+                    except ValueError: # symengine was built without LLVM
+                        self.compiled = symengine.Lambdify(arguments, expressions, real=True, cse=True)
+
+                else:
+                    self.compiled = sp.lambdify(self.symbols, tuple(self.expressions),
+                                                cse=True, docstring_limit=0)
+
+                self.backend = backend
+                return
+
+            except Exception as e: self.fallback(backend, e)
+
+    def fallback(self, backend, error):
+        sys.stderr.write('warning: %s could not compile element kernel (%s); falling back.\n' %
+                         (backend, type(error).__name__))
+
+    # Compiled kernels are recompiled (or reloaded from numba's cache) when unpickling.
+    # Stale entries in the disk cache from older formats are still pickled when the cache is
+    # saved, so we keep whatever state they have rather than listing the attributes.
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k not in ['compiled', 'backend']}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile()
+
+    def __call__(self, *args, out=None):
+        """Evaluate the expressions in every element.
+
+        Args:
+            *args: value of each argument in every element (or at every node), followed by
+                the values of the parameters. Vector arguments are 2d arrays with the vector
+                along the last axis.
+            out: optional output buffer of shape (nelements, len(expressions)).
+        Returns:
+            Array of the expressions evaluated for each element.
+        """
+        *args, parameters = args
+        args = [np.asarray(a, dtype=np.float64) for a in args]
+        parameters = np.asarray(parameters, dtype=np.float64)
+        nelements = len(args[0]) - self.node_arguments[0]
+        if out is None: out = np.empty((nelements, self.noutputs))
+
+        # The compiled kernels do not check bounds, so inconsistent inputs would read (or write)
+        # past the end of the arrays.
+        for i, (a, is_node, shape) in enumerate(zip(args, self.node_arguments, self.argument_shapes)):
+            expected = (nelements + is_node,) + shape
+            if a.shape != expected:
+                raise ValueError('argument %d to element kernel has shape %r (expected %r)!' %
+                                 (i, a.shape, expected))
+        if parameters.shape != (self.nparameters,):
+            raise ValueError('element kernel takes %d parameters (got %r)!' %
+                             (self.nparameters, parameters.shape))
+        if out.shape != (nelements, self.noutputs):
+            raise ValueError('output buffer for element kernel has shape %r (expected %r)!' %
+                             (out.shape, (nelements, self.noutputs)))
+
+        if self.backend == 'numba':
+            # Failures to lower the kernel only appear on the first call.
+            try:
+                self.compiled(*args, parameters, out)
+                return out
+            except Exception as e:
+                self.fallback('numba', e)
+                self.compile(self.backends[1:])
+
+        # The remaining backends take each argument in a separate column, with node arguments
+        # split into their values on the left and right of each element.
+        flattened = []
+        for a, is_node, is_vector in zip(args, self.node_arguments, self.vector_arguments):
+            for side in ((a[:-1], a[1:]) if is_node else (a,)):
+                if is_vector: flattened += list(side.T)
+                else: flattened += [side]
+
+        if self.backend == 'symengine':
+            columns = np.empty((nelements, len(self.symbols)))
+            columns[:,:len(flattened)] = np.transpose(flattened)
+            columns[:,len(flattened):] = parameters
+            self.compiled(columns, out=out)
+            return out
+
+        for i, value in enumerate(self.compiled(*flattened, *parameters)):
+            out[:,i] = value
+        return out
+
+def assemble_nodes(contributions, shift, out):
+    """Combine the contributions of each element to the equations of its two nodes.
+
+    Each node receives contributions from the element on its right (where it is the left
+    boundary) and from the element on its left (where it is the right boundary). Entries along
+    the last axis (e.g. variables for Jacobians) of the former are offset by shift.
+
+    Args:
+        contributions: array of shape (nelements, 2, order, nvariables) containing the
+            contributions of each element to its left and right nodes.
+        shift: offset of the contributions to the left node along the last axis of out.
+        out: output buffer of shape (nelements+1, order, nvariables+shift).
+    Returns:
+        The output buffer.
+    """
+    nvariables = contributions.shape[-1]
+    out[...] = 0
+    out[:-1,:,shift:] = contributions[:,0]
+    out[1:,:,:nvariables] += contributions[:,1]
+    return out
+
+if numba is not None:
+    # Nodes are independent so we can assemble them in parallel. This is a gather over
+    # neighbouring elements, so unlike a scatter from each element there are no races.
+    @numba.njit(parallel=True, cache=True)
+    def assemble_nodes(contributions, shift, out):
+        nelements, _, order, nvariables = contributions.shape
+        for n in numba.prange(nelements+1):
+            for d in range(order):
+                for v in range(out.shape[2]):
+                    out[n, d, v] = 0
+                if n < nelements:
+                    for v in range(nvariables):
+                        out[n, d, v+shift] += contributions[n, 0, d, v]
+                if n > 0:
+                    for v in range(nvariables):
+                        out[n, d, v] += contributions[n-1, 1, d, v]
+        return out
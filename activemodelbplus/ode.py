@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
 
 import numpy as np
-from scipy.linalg import solve_banded
+from scipy.linalg import get_lapack_funcs
 from scipy.integrate._quadrature import _cached_roots_legendre
 import sympy as sp
 
 from .interpolate import HermiteInterpolatingPolynomial, HermiteInterpolator
 from . import differentiate
 from .cache import cache, cached_property, disk_cache
+from .jit import JitFunction, ElementKernel, assemble_nodes, compiled_format_version
 
-import sys
+import sys, hashlib
+from collections import defaultdict
 # print_compilation_updates = None
 print_compilation_updates = sys.stderr
 
@@ -20,6 +22,12 @@ class WeakFormProblem1d:
 
     parameters = []
 
+    # Whether to compile the elemental kernels specifically for the values of the parameters
+    # given to each instance, so the compiler can fold the parameters in as constants. This is
+    # faster to evaluate but has to recompile the kernels for every new set of parameters, so
+    # it only pays off for problems that are solved many times with the same parameters.
+    specialise_parameters = False
+
     def __init__(self, *args):
         """Instantiate problem with specific parameters.
 
@@ -27,7 +35,16 @@ class WeakFormProblem1d:
             *args: values of parameters in same order as parameters class variable.
         """
         assert len(args) is len(self.parameters)
-        self.parameter_values = args
+        self.parameter_values = tuple(args)
+        # Packed once for the compiled kernels, which take parameters as a single array (which
+        # is empty when the parameters are already substituted into the kernels).
+        if self.specialise_parameters:
+            # Normalised so that e.g. 1 and 1.0 share the same compiled (and cached) kernels.
+            self.specialised_parameter_values = tuple(float(v) for v in args)
+            self.parameter_array = np.empty(0)
+        else:
+            self.specialised_parameter_values = None
+            self.parameter_array = np.array(self.parameter_values, dtype=np.float64)
 
     @classmethod
     @property
@@ -75,6 +92,22 @@ class WeakFormProblem1d:
     def boundary_conditions(cls):
         raise NotImplementedError('boundary conditions have not been specified!')
 
+    @classmethod
+    @property
+    @cache
+    def disk_cache_key(cls):
+        """Identifies the problem in the disk cache of compiled expressions by its definition
+        as well as its name, so editing a problem invalidates its cached compilations. The
+        format version of the compiled objects is included so that changes to the compiled
+        objects themselves also invalidate the cache."""
+        definition = [cls.weak_form, cls.natural_boundary_condition, cls.parameters,
+                      cls.boundary_left, cls.boundary_right]
+        definition = [sp.srepr(d) for d in definition]
+        # Boundary conditions are a set, so we sort them to make the key stable between sessions.
+        definition += sorted(sp.srepr(bc) for bc in cls.boundary_conditions)
+        digest = hashlib.sha1('\n'.join(definition).encode()).hexdigest()
+        return (cls.__module__, cls.__qualname__, digest, compiled_format_version)
+
     @classmethod
     @property
     @cache
@@ -86,11 +119,24 @@ class WeakFormProblem1d:
     @property
     @cache
     def compiled_exact_solution(cls):
-        return sp.lambdify([cls.argument] + cls.parameters, cls.analytic_solution)
+        return sp.lambdify([cls.argument] + cls.parameters, cls.analytic_solution, cse=True, docstring_limit=0)
 
     def exact_solution(self, x):
         return self.compiled_exact_solution(x, *self.parameter_values)
 
+    def evaluate(self, function, nodes, weights, element):
+        """Evaluate a compiled elemental function on a single element with this problem's
+        parameters.
+
+        Args:
+            function: compiled function taking arguments in order of elemental_variables.
+            nodes: positions of the nodes in the mesh.
+            weights: weights at every node, with a row per node.
+            element: index of the element.
+        """
+        xleft, xright = nodes[element:element+2]
+        return function(xleft, xright, *weights[element:element+2].reshape(-1), *self.parameter_values)
+
     @classmethod
     def elemental_variables(cls, order=1):
         """Variables taken as arguments to expression in numerical evaluations (i.e. including
@@ -129,7 +175,7 @@ class WeakFormProblem1d:
 
         arguments = cls.elemental_variables(order)
         for boundary in expressions: # loop over left and right expressions
-            compiled_expressions += [[sp.lambdify(arguments, e) for e in boundary]]
+            compiled_expressions += [[JitFunction(arguments, e) for e in boundary]]
 
         if print_compilation_updates: print_compilation_updates.write(' done.\n')
         return compiled_expressions
@@ -152,16 +198,13 @@ class WeakFormProblem1d:
             print_compilation_updates.write('%s: compiling natural boundary Jacobians...' % cls.name)
             print_compilation_updates.flush()
 
+        # The Jacobian on each boundary is compiled into a single function returning the full
+        # matrix, with a row for each residual and a column for each weight variable.
         compiled_jacobians = []
         left, right = cls.natural_boundary_condition_jacobians(order, *args, **kwargs)
+        arguments = cls.elemental_variables(order)
         for jacobians in [left, right]:
-            boundary_jacobians = []
-            for row in jacobians:
-                compiled_row = []
-                for expression in row:
-                    compiled_row += [sp.lambdify(cls.elemental_variables(order), expression)]
-                boundary_jacobians += [compiled_row]
-            compiled_jacobians += [boundary_jacobians]
+            compiled_jacobians += [JitFunction(arguments, sp.Matrix(jacobians))]
 
         if print_compilation_updates: print_compilation_updates.write(' done.\n')
         return compiled_jacobians
@@ -193,13 +236,31 @@ class WeakFormProblem1d:
         expressions = cls.boundary_condition_expressions(order, *args, **kwargs)
         compiled_expressions = []
 
+        # The point may be an analytic expression of the parameters, so we compile it too.
         arguments = cls.elemental_variables(order)
         for point, expression in expressions:
-            compiled_expressions += [(point, sp.lambdify(arguments, expression))]
+            compiled_expressions += [(sp.lambdify(cls.parameters, point, cse=True, docstring_limit=0),
+                                      JitFunction(arguments, expression))]
 
         if print_compilation_updates: print_compilation_updates.write(' done.\n')
         return compiled_expressions
 
+    def locate_boundary_conditions(self, nodes, points):
+        """Find where boundary conditions fall on the mesh.
+
+        Args:
+            nodes: sorted positions of the nodes.
+            points: locations of the boundary conditions compiled as functions of the parameters.
+        Returns:
+            elements: the element containing each boundary condition.
+            closest_nodes: the node closest to each boundary condition.
+        """
+        points = np.array([p(*self.parameter_values) for p in points], dtype=np.float64)
+        nelements = len(nodes) - 1
+        elements = np.clip(np.searchsorted(nodes, points, side='right') - 1, 0, nelements-1)
+        closest_nodes = elements + (points - nodes[elements] > nodes[elements+1] - points)
+        return elements, closest_nodes
+
     @classmethod
     @cache
     def boundary_condition_jacobians(cls, order=1):
@@ -219,11 +280,11 @@ class WeakFormProblem1d:
 
         jacobians = cls.boundary_condition_jacobians(order, *args, **kwargs)
         compiled_jacobians = []
+
+        arguments = cls.elemental_variables(order)
         for point, row in jacobians:
-            compiled_row = []
-            for expression in row:
-                compiled_row += [sp.lambdify(cls.elemental_variables(order), expression)]
-            compiled_jacobians += [(point, compiled_row)]
+            compiled_jacobians += [(sp.lambdify(cls.parameters, point, cse=True, docstring_limit=0),
+                                    JitFunction(arguments, row))]
 
         if print_compilation_updates: print_compilation_updates.write(' done.\n')
         return compiled_jacobians
@@ -241,6 +302,10 @@ class WeakFormProblem1d:
         # determine the location of points to sample and the weights. These are pre-calculated
         # in numpy in the [-1, 1] interval:
         roots, weights = _cached_roots_legendre(2*order+1)
+        # These are numerical values anyway, so we keep them as (full precision) floats rather
+        # than letting sympy attempt exact arithmetic with them.
+        roots = [sp.Float(float(r)) for r in roots]
+        weights = [sp.Float(float(w)) for w in weights]
         # Transform to general interval [x0, x1]:
         x = polynomial.inverse_coordinate_transform
         dxds = sp.Lambda(cls.argument, x.diff(cls.argument))
@@ -251,85 +316,116 @@ class WeakFormProblem1d:
         for i,w in enumerate(polynomial.general_weight_functions):
             specific_integrand = basic_integrand.subs(cls.basis_function,
                                                       sp.Lambda(cls.argument, w)).doit()
-            result = sum([w*specific_integrand.subs(cls.argument, p).doit() for p, w in zip(roots, weights)])
+            # Collect the terms for each quadrature point into a single Add, rather than
+            # building (and flattening) each partial sum in turn.
+            terms = [w*specific_integrand.subs(cls.argument, p) for p, w in zip(roots, weights)]
+            result = sp.Add(*terms)
 
-            residuals += [result]
+            # Evaluate remaining rational coefficients as floats ready for numerical evaluation.
+            # N.B. we deliberately do not expand the result: this destroys the common
+            # subexpressions between quadrature points, inflating the compiled kernels.
+            residuals += [result.evalf()]
 
         return residuals
 
+    @classmethod
+    def specialise(cls, expressions, parameter_values=None):
+        """Substitute values of the parameters into expressions to be compiled.
+
+        Args:
+            expressions: list of sympy expressions depending on the parameters.
+            parameter_values: values of the parameters, or None to leave them as symbols.
+        Returns:
+            The expressions and the parameters they still depend on.
+        """
+        if parameter_values is None: return expressions, cls.parameters
+        values = {p: sp.Float(v) for p, v in zip(cls.parameters, parameter_values)}
+        return [e.xreplace(values) for e in expressions], []
+
+    @classmethod
+    def element_kernel_arguments(cls, order):
+        """Arguments of the compiled elemental kernels (cf. ElementKernel).
+
+        Node positions and weights are passed for the whole mesh, and each element takes the
+        values on its left and right nodes.
+
+        Args:
+            order: order of the interpolating polynomial.
+        Returns:
+            List of the node positions and weights as (left, right) pairs.
+        """
+        polynomial = HermiteInterpolatingPolynomial.from_cache(order, cls.argument)
+        weights = polynomial.weight_variables
+        return [(polynomial.x0, polynomial.x1), (weights[:order], weights[order:])]
+
     @classmethod
     @cache
     @disk_cache
-    def compiled_elemental_residuals(cls, order, *args, **kwargs):
+    def compiled_elemental_residuals(cls, order, *args, parameter_values=None, **kwargs):
         if print_compilation_updates:
             print_compilation_updates.write('%s: compiling main residuals...' % cls.name)
             print_compilation_updates.flush()
 
+        # All residuals are evaluated by a single kernel, so the weights in each element are
+        # only read once.
+        arguments = cls.element_kernel_arguments(order)
         residuals = cls.elemental_residuals(order, *args, **kwargs)
-        compiled_residuals = []
-        for expression in residuals:
-            compiled_residuals += [sp.lambdify(cls.elemental_variables(order), expression)]
+        residuals, parameters = cls.specialise(residuals, parameter_values)
+        compiled_residuals = ElementKernel(arguments, residuals, parameters)
 
         if print_compilation_updates: print_compilation_updates.write(' done.\n')
         return compiled_residuals
 
-    def residuals(self, nodes, weights, *args, **kwargs):
+    def residuals(self, nodes, weights, *args, out=None, **kwargs):
         nelements, order = weights.shape
         nelements -= 1
 
-        R = np.zeros(weights.shape)
-
-        polynomial = HermiteInterpolatingPolynomial.from_cache(order, self.argument)
-        variables = polynomial.weight_variables
-        functions = self.compiled_elemental_residuals(order, *args, **kwargs)
+        kernel = self.compiled_elemental_residuals(
+            order, *args, parameter_values=self.specialised_parameter_values, **kwargs)
 
-        xleft, xright = nodes[:-1], nodes[1:]
-        w = np.hstack((weights[:-1], weights[1:]))
+        # Residual contributions from each element: the first order entries correspond to
+        # weights of the left node and the remaining to the right node.
+        with np.errstate(all='raise'):
+            r = kernel(nodes, weights, self.parameter_array)
 
-        for var, func in zip(variables, functions):
-            with np.errstate(all='raise'):
-                r = func(xleft, xright, *w.T, *self.parameter_values)
-
-            boundary, deriv = var.indices
-            if boundary == 0: R[:-1,deriv] += r
-            elif boundary == 1: R[1:,deriv] += r
-            else: raise RuntimeError('unknown variable indices during residual calculation!')
+        # Combine contributions to each node from the elements on its left and right.
+        if out is None: out = np.empty(weights.size)
+        R = out.reshape(weights.shape)
+        assemble_nodes(r.reshape(nelements, 2, order, 1), 0, R.reshape(-1, order, 1))
 
         # Apply natural boundary condition needed to make weak form valid (these conditions
         # arise from surface terms left over from e.g. integration by parts).
         if self.natural_boundary_condition:
             left, right = self.compiled_natural_boundary_condition_expressions(order)
             for c, (l, r) in enumerate(zip(left, right)):
-                with np.errstate(divide='raise'):
-                    if self.boundary_left:
-                        R[c//order, c%order] += l(xleft[0], xright[0], *w[0], *self.parameter_values)
-                    if self.boundary_right:
-                        R[-2 + c//order, c%order] += r(xleft[-1], xright[-1], *w[-1], *self.parameter_values)
+                if self.boundary_left:
+                    R[c//order, c%order] += self.evaluate(l, nodes, weights, 0)
+                if self.boundary_right:
+                    R[-2 + c//order, c%order] += self.evaluate(r, nodes, weights, nelements-1)
 
         # Evaluate residual contributions from specific boundary conditions.
-        element_edges = nodes[:-1]
-        bcs = {}
-        for point, func in self.compiled_boundary_condition_expressions(order):
-            # If point is an analytic expression we may need to evaluate it.
-            point = sp.lambdify(self.parameters, point)(*self.parameter_values)
-
+        compiled_bcs = self.compiled_boundary_condition_expressions(order)
+        elements, closest_nodes = self.locate_boundary_conditions(nodes, [p for p, _ in compiled_bcs])
+        bcs = defaultdict(list)
+        for (point, func), element, closest_node in zip(compiled_bcs, elements, closest_nodes):
             # Evaluate boundary condition on the local element
-            element = np.digitize(point, element_edges)-1
-            xleft, xright = nodes[element:element+2]
-            value = func(xleft, xright, *w[element], *self.parameter_values)
+            value = self.evaluate(func, nodes, weights, element)
 
             # We will place the boundary condition on a residual entry for the closest node,
             # because it should depend on local weights there.
-            closest_node = np.abs(nodes - point).argmin()
-            try: bcs[closest_node] += [value]
-            except: bcs[closest_node] = [value]
+            bcs[closest_node].append(value)
 
         # Make sure boundary conditions fall on distinct residual entries for the selected nodes.
         for node, conditions in bcs.items():
             for i, value in enumerate(conditions):
                 R[node,i] = value
 
-        return R.reshape(-1)
+        # Compiled functions do not respect np.errstate, so check for floating point errors
+        # (e.g. division by zero in the boundary terms) in the assembled residuals here.
+        if not np.all(np.isfinite(R)):
+            raise FloatingPointError('non-finite residual encountered during residual calculation!')
+
+        return out
 
     @classmethod
     @cache
@@ -343,85 +439,63 @@ class WeakFormProblem1d:
     @classmethod
     @cache
     @disk_cache
-    def compiled_elemental_jacobians(cls, order, *args, **kwargs):
+    def compiled_elemental_jacobians(cls, order, *args, parameter_values=None, **kwargs):
         if print_compilation_updates:
             print_compilation_updates.write('%s: compiling main Jacobians...' % cls.name)
             print_compilation_updates.flush()
 
+        # The whole elemental Jacobian (flattened in row-major order) is evaluated by a single
+        # kernel, so common subexpressions are shared between all entries.
+        arguments = cls.element_kernel_arguments(order)
         jacobians = cls.elemental_jacobians(order, *args, **kwargs)
-        compiled_jacobians = []
-        for row in jacobians:
-            compiled_row = []
-            for expression in row:
-                compiled_row += [sp.lambdify(cls.elemental_variables(order), expression)]
-            compiled_jacobians += [compiled_row]
+        jacobians, parameters = cls.specialise(sum(jacobians, []), parameter_values)
+        compiled_jacobians = ElementKernel(arguments, jacobians, parameters)
 
         if print_compilation_updates: print_compilation_updates.write(' done.\n')
         return compiled_jacobians
 
-    def jacobian(self, nodes, weights, *args, **kwargs):
+    def jacobian(self, nodes, weights, *args, out=None, **kwargs):
         nelements, order = weights.shape
         nelements -= 1
 
-        # Equations depend on 3*order variables (1 x order for each of left, central and right
-        # points) in each element.
-        J = np.zeros((3*order, nelements+1, order))
-
-        polynomial = HermiteInterpolatingPolynomial.from_cache(order, self.argument)
-        variables = polynomial.weight_variables
-        functions = self.compiled_elemental_jacobians(order, *args, **kwargs)
-
-        xleft, xright = nodes[:-1], nodes[1:]
-        w = np.hstack((weights[:-1], weights[1:]))
+        kernel = self.compiled_elemental_jacobians(
+            order, *args, parameter_values=self.specialised_parameter_values, **kwargs)
 
-        for var, row in zip(variables, functions):
-            boundary, deriv = var.indices
+        # Rows of the elemental Jacobians correspond to the residuals for the weights on the
+        # left and right nodes, and columns to the 2*order variables of the element.
+        j = kernel(nodes, weights, self.parameter_array)
 
-            for i, func in enumerate(row):
-                j = func(xleft, xright, *w.T, *self.parameter_values)
-                if boundary == 0:
-                    J[i+order,:-1,deriv] += j
-                elif boundary == 1:
-                    J[i,1:,deriv] += j
-                else: raise RuntimeError('unknown variable indices during residual calculation!')
-
-        J = J.reshape(len(J), -1)
+        # Equations depend on 3*order variables (1 x order for each of left, central and right
+        # points) in each element. The equations of each node get contributions from the
+        # element on its right (depending on the last 2*order variables) and on its left
+        # (depending on the first 2*order variables).
+        J = np.empty((3*order, (nelements+1)*order))
+        assemble_nodes(j.reshape(nelements, 2, order, 2*order), order,
+                       J.reshape(3*order, nelements+1, order).transpose(1, 2, 0))
 
         # Apply natural boundary condition needed to make weak form valid (these conditions
         # arise from surface terms left over from e.g. integration by parts).
         if self.natural_boundary_condition:
             left, right = self.compiled_natural_boundary_condition_jacobians(order)
-            for c, (l, r) in enumerate(zip(left, right)):
-                starting_row = len(J)//2 - c
-
-                eqn = -2*order+c
-                if self.boundary_right:
-                    r = [f(xleft[-1], xright[-1], *w[-1], *self.parameter_values) for f in r]
-                    J[:len(r), eqn] += r
-
-                eqn = c
-                if self.boundary_left:
-                    l = [f(xleft[0], xright[0], *w[0], *self.parameter_values) for f in l]
-                    J[order:order+len(l), eqn] += l
+            # Equations for the last element are in the final 2*order columns and depend on
+            # the first 2*order variables; conversely for the first element.
+            if self.boundary_right:
+                J[:2*order,-2*order:] += self.evaluate(right, nodes, weights, nelements-1).T
+            if self.boundary_left:
+                J[order:,:2*order] += self.evaluate(left, nodes, weights, 0).T
 
         # Apply boundary conditions.
-        element_edges = nodes[:-1]
-        bcs = {}
-        for point, row in self.compiled_boundary_condition_jacobians(order):
-            # If point is an analytic expression we may need to evaluate it.
-            point = sp.lambdify(self.parameters, point)(*self.parameter_values)
-
-            element = np.digitize(point, element_edges)-1
-            closest_node = np.abs(nodes - point).argmin()
-            xleft, xright = nodes[element:element+2]
-            values = [func(xleft, xright, *w[element], *self.parameter_values) for func in row]
+        compiled_bcs = self.compiled_boundary_condition_jacobians(order)
+        elements, closest_nodes = self.locate_boundary_conditions(nodes, [p for p, _ in compiled_bcs])
+        bcs = defaultdict(list)
+        for (point, row), element, closest_node in zip(compiled_bcs, elements, closest_nodes):
+            values = self.evaluate(row, nodes, weights, element)
 
             boundary_on_left = closest_node == element
             if boundary_on_left: entry = np.concatenate((np.zeros(order), values))
             else: entry = np.concatenate((values, np.zeros(order)))
 
-            try: bcs[closest_node] += [entry]
-            except: bcs[closest_node] = [entry]
+            bcs[closest_node].append(entry)
 
         # Ensure boundary conditions are placed on distinct rows
         for node, conditions in bcs.items():
@@ -430,22 +504,38 @@ class WeakFormProblem1d:
                 J[:, eqn] = entry
 
         # Each row now contains the nonzero Jacobian entries for each residual, but
-        # we have to shift these to correspond to the matrix format needed by
-        # scipy.linalg.solve_banded.
+        # we have to scatter these into the matrix format needed by scipy.linalg.solve_banded
+        # (which stores each diagonal of the matrix in a separate row).
+        rows, offsets = self.banded_indices(order)
+        columns = order*np.arange(-1, nelements).reshape(1, -1, 1) + offsets
+        J = J.reshape(3*order, nelements+1, order)
 
-        # Add extra rows and shift columns so that each equation's own node runs along the diagonal.
-        ncols = J.shape[1]
-        J = np.vstack((np.zeros((order-1, ncols)), J))
-        for c in range(1,order):
-            J[:,c::order] = np.roll(J[:,c::order], -c, axis=0)
+        if out is None: out = np.empty((4*order-1, (nelements+1)*order))
+        out[...] = 0
+        # The first and last nodes have no variables on their left and right respectively.
+        out[rows[order:], columns[order:,:1]] = J[order:,:1]
+        out[rows, columns[:,1:-1]] = J[:,1:-1]
+        out[rows[:2*order], columns[:2*order,-1:]] = J[:2*order,-1:]
+        return out
 
-        # Shift the elements for each equation so elements of a single equation are stored
-        # diagonally (cf. scipy.linalg.solve_banded which documents the matrix storage format).
-        J = np.flipud(J)
-        for c in range(len(J)):
-            J[c] = np.roll(J[c], len(J)//2-c)
+    @classmethod
+    @cache
+    def banded_indices(cls, order):
+        """Positions of the entries of the Jacobian (as assembled in jacobian()) in the
+        matrix format of scipy.linalg.solve_banded.
 
-        return J
+        Entry (k, node, derivative) is the derivative of the residual of equation
+        node*order + derivative with respect to variable (node-1)*order + k.
+
+        Args:
+            order: order of the interpolating polynomial.
+        Returns:
+            Banded row of each entry, and column of each entry relative to the variable
+            (node-1)*order.
+        """
+        k = np.arange(3*order).reshape(-1, 1, 1)
+        derivative = np.arange(order).reshape(1, 1, -1)
+        return 3*order - 1 + derivative - k, k
 
     def numerical_jacobian(self, nodes, weights, dx=1e-4):
         from differentiate import gradient
@@ -458,19 +548,47 @@ class WeakFormProblem1d:
         nnodes = J.shape[1]
         Jfull = np.zeros((nnodes, nnodes))
 
-        for i in range(nnodes):
-            for j in range(nnodes):
-                if (u + i - j) < 0 or (u + i - j) >= len(J): continue
-                Jfull[i, j] = J[u + i - j, j]
+        # Entry J[u + i - j, j] of the banded storage is the full matrix element (i, j), so we
+        # scatter the whole band at once (dropping the unused corners of the storage).
+        band, j = np.indices(J.shape)
+        i = band + j - u
+        inside = (i >= 0) & (i < nnodes)
+        Jfull[i[inside], j[inside]] = J[inside]
         return Jfull
 
     def solve(self, nodes, weights,
               newton_atol=1e-6, newton_rtol=1e-8, max_newton_iters=25, exceed_max_iters='warn',
-              print_updates=None, **kwargs):
+              refactor_interval=1, print_updates=None, **kwargs):
+        """Solve the problem by Newton iteration from an initial guess.
+
+        Args:
+            nodes: positions of the nodes in the mesh.
+            weights: initial guess for the weights of the interpolating polynomial at each node.
+                These are updated in place.
+            newton_atol: tolerance for residuals at convergence.
+            newton_rtol: tolerance for the relative change in weights at convergence.
+            max_newton_iters: maximum number of iterations.
+            exceed_max_iters: 'warn' or 'raise' if the solution does not converge.
+            refactor_interval: number of iterations between recalculating the Jacobian. The
+                default updates it every iteration (a full Newton method); larger intervals
+                reuse its LU factorisation for cheaper (but slower converging) iterations.
+            print_updates: stream to write progress to.
+        Returns:
+            Weights at the solution.
+        """
+        if refactor_interval < 1:
+            raise ValueError('refactor_interval must be at least 1 (got %r)!' % refactor_interval)
+
         nelements, order = weights.shape
         nelements -= 1
 
-        R = self.residuals(nodes, weights)
+        # Work buffers are allocated once and reused each iteration.
+        R = self.residuals(nodes, weights, out=np.empty(weights.size))
+        delta = np.empty(weights.shape)
+        relative_change = np.empty(weights.size)
+        u = 2*order - 1
+        lu = np.empty((3*u+1, weights.size), order='F')
+        gbtrf, gbtrs = get_lapack_funcs(('gbtrf', 'gbtrs'), (lu,))
         assert nodes.size == nelements+1
         assert R.size == order*(nelements+1)
 
@@ -514,21 +632,38 @@ class WeakFormProblem1d:
 
                 # plt.show()
 
-            J = self.jacobian(nodes, weights)
-
-            u = (J.shape[0]-1) // 2
-            delta = solve_banded((u, u), J, -R).reshape(weights.shape)
+            if iters % refactor_interval == 0:
+                # Factorise the banded matrix directly with LAPACK (as in solve_banded), which
+                # needs an extra u rows of storage for the fill-in during pivoting. The
+                # Jacobian is assembled directly into the remaining rows.
+                self.jacobian(nodes, weights, out=lu[u:])
+                lu, pivots, info = gbtrf(lu, u, u, overwrite_ab=True)
+                if info > 0: raise np.linalg.LinAlgError('singular matrix')
+                if info < 0:
+                    raise ValueError('illegal value in %d-th argument of internal gbtrf' % -info)
+
+            # Solve for the update in place: LAPACK overwrites the negated residuals with the
+            # solution. Unlike solve_banded, this does not scan the Jacobian for non-finite
+            # values, so we check the (much smaller) update instead before it is applied to
+            # the caller's weights.
+            rhs = np.negative(R, out=delta.reshape(-1))
+            solution, info = gbtrs(lu, u, u, rhs, pivots, overwrite_b=True)
+            if info < 0:
+                raise ValueError('illegal value in %d-th argument of internal gbtrs' % -info)
+            if solution is not rhs: rhs[:] = solution
+            if not np.all(np.isfinite(delta)):
+                raise FloatingPointError('non-finite update encountered during ODE solve step!')
             # from scipy.optimize import line_search
             # line_search(obj_func, obj_grad, start_point, search_gradient)
             if print_updates: print_updates.write('%r delta=%r\n' % (iters, delta))
             weights += delta
 
-            R = self.residuals(nodes, weights)
+            self.residuals(nodes, weights, out=R)
             iters += 1
             if print_updates: print_updates.write('%r R=%r\n' % (iters, update(R)))
 
             with np.errstate(invalid='ignore', divide='ignore'):
-                relative_change = np.divide(delta, weights).reshape(-1)
+                np.divide(delta.reshape(-1), weights.reshape(-1), out=relative_change)
             relative_change[~np.isfinite(relative_change)] = 0
             relative_change[np.abs(R) < newton_atol] = 0
             if np.linalg.norm(relative_change) < newton_rtol: break
@@ -563,6 +698,8 @@ class HeatEquation(WeakFormProblem1d):
 class GinzburgLandauFlatInterface(WeakFormProblem1d):
     a, g, k = sp.symbols('a g K')
     parameters = [a, g, k]
+    # Interfaces are typically computed once for a fixed set of parameters.
+    specialise_parameters = True
 
     @classmethod
     @property
@@ -583,7 +720,7 @@ class GinzburgLandauFlatInterface(WeakFormProblem1d):
 
     @property
     def numerical_domain_size(self):
-        return sp.lambdify(self.parameters, self.domain_size)(*self.parameter_values)
+        return sp.lambdify(self.parameters, self.domain_size, cse=True, docstring_limit=0)(*self.parameter_values)
 
     @classmethod
     @property
@@ -634,7 +771,7 @@ if __name__ == '__main__':
     w = np.zeros((len(x), order))
     exact = p.analytic_solution.subs({p: v for p, v in zip(p.parameters, p.parameter_values)})
     for c in range(order):
-        w[:,c] = sp.lambdify(p.argument, exact.diff(p.argument, c))(x)
+        w[:,c] = sp.lambdify(p.argument, exact.diff(p.argument, c), cse=True, docstring_limit=0)(x)
 
     w = p.solve(x, w, print_updates=sys.stderr)
     f = HermiteInterpolator(x, w)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import pytest
+import numpy as np
+import copy
+
+import sys, os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from activemodelbplus.ode import HeatEquation, GinzburgLandauFlatInterface
+from activemodelbplus.jit import ElementKernel
+
+def problems():
+    return [(HeatEquation(), np.array([0, 0.3, 1])),
+            (GinzburgLandauFlatInterface(-1, 1, 0.02), np.array([-2, -0.5, 0, 1, 2.]))]
+
+def trial_weights(nodes, order):
+    n = len(nodes)
+    return (np.arange(n*order).reshape(n, order) + 1) / (n*order) - 0.5
+
+# Residuals and full Jacobians computed with the original (pure sympy/numpy) implementation of
+# the solver. In both problems a boundary condition lies exactly on the last node.
+reference_residuals = {
+    ('HeatEquation', 1): [-1.16666666667, -0.634920634921, 0.5],
+    ('HeatEquation', 2): [-1.33333333333, 0.277777777778, -0.828571428571, 0.250793650794,
+                          0.333333333333, -0.0269841269841],
+    ('GinzburgLandauFlatInterface', 1): [0.7, 0.1236, 0.1, -0.267, -0.5],
+    ('GinzburgLandauFlatInterface', 2): [0.6, 0.0758270261191, 0.213145740776, -0.0581456844363,
+                                         0, -0.0184265843271, -0.177172187229, -0.0238605218219,
+                                         -0.6, 0.0461062960163]
+}
+
+# Full Jacobians computed with the original (pure sympy/numpy) implementation of the solver.
+reference_jacobians = {
+    ('HeatEquation', 1):
+        [[1, 0, 0],
+         [3.33333333333, -4.7619047619, 1.42857142857],
+         [0, 0, 1]],
+    ('HeatEquation', 2):
+        [[1, 0, 0, 0, 0, 0],
+         [-0.666666666667, -0.266666666667, 0.666666666667, 0.0666666666667, 0, 0],
+         [4, 0.1, -5.71428571429, 0, 1.71428571429, -0.1],
+         [-0.666666666667, 0.0666666666667, 0.380952380952, -0.533333333333, 0.285714285714, 0.0666666666667],
+         [0, 0, 0, 0, 1, 0],
+         [0, 0, -0.285714285714, 0.0666666666667, 0.285714285714, -0.266666666667]],
+    ('GinzburgLandauFlatInterface', 1):
+        [[1, 0, 0, 0, 0],
+         [-0.231833333333, -0.575333333333, -0.122833333333, 0, 0],
+         [0, 0, 1, 0, 0],
+         [0, 0, -0.165666666667, -0.438666666667, -0.105666666667],
+         [0, 0, 0, 0, 1]],
+    ('GinzburgLandauFlatInterface', 2):
+        [[1, 0, 0, 0, 0, 0, 0, 0, 0, 0],
+         [-0.0811252519526, -0.0188597765495, -0.0660086766188, 0.0197154785525, 0, 0, 0, 0, 0, 0],
+         [-0.14222239544, -0.0495065074641, -0.56051973629, 0.0795189384396, -0.109448344461, 0.00934734688629, 0, 0, 0, 0],
+         [0.0608930303603, 0.0197154785525, 0.0791653859074, -0.025642319119, -0.0378024638868, 0.0020840957525, 0, 0, 0, 0],
+         [0, 0, 0, 0, 1, 0, 0, 0, 0, 0],
+         [0, 0, 0.0373893875451, 0.0020840957525, -0.056412016041, -0.0128135327433, -0.0642898715042, 0.0126449357521, 0, 0],
+         [0, 0, 0, 0, -0.149670823885, -0.0321449357521, -0.605272528765, 0.00791551188377, -0.122437599731, 0.0259818384144],
+         [0, 0, 0, 0, 0.0647660619803, 0.0126449357521, 0.0158310237675, -0.0227779877383, -0.0508828000336, 0.00962469555724],
+         [0, 0, 0, 0, 0, 0, 0, 0, 1, 0],
+         [0, 0, 0, 0, 0, 0, 0.0519636768288, 0.00962469555724, 0.0708696565046, -0.00867538002855]]
+}
+
+@pytest.mark.parametrize('order', [1, 2])
+def test_residuals(order):
+    for problem, nodes in problems():
+        weights = trial_weights(nodes, order)
+        R = problem.residuals(nodes, weights)
+        expected = reference_residuals[problem.name, order]
+        assert np.allclose(R, expected, rtol=1e-9, atol=1e-11)
+
+@pytest.mark.parametrize('order', [1, 2])
+def test_jacobian(order):
+    for problem, nodes in problems():
+        weights = trial_weights(nodes, order)
+        J = problem.full_jacobian(problem.jacobian(nodes, weights))
+        expected = reference_jacobians[problem.name, order]
+        assert np.allclose(J, expected, rtol=1e-9, atol=1e-11)
+
+@pytest.mark.parametrize('order', [1, 2])
+def test_element_kernel_backends(order):
+    for problem, nodes in problems():
+        weights = trial_weights(nodes, order)
+        parameters = np.array(problem.parameter_values, dtype=np.float64)
+
+        for kernel in [problem.compiled_elemental_residuals(order),
+                       problem.compiled_elemental_jacobians(order)]:
+            values = {}
+            for backend in ElementKernel.backends:
+                # Compile a copy so we do not change the backend of the cached kernel.
+                specific = copy.copy(kernel)
+                specific.backend = None
+                specific.compile([backend])
+                # Optional dependencies may not be installed.
+                if specific.backend != backend: continue
+                values[backend] = specific(nodes, weights, parameters)
+
+            assert 'numpy' in values
+            for backend, value in values.items():
+                assert np.allclose(value, values['numpy'], rtol=1e-9, atol=1e-12), backend
+
+def test_mismatched_mesh():
+    # Element kernels index the nodes and weights without bounds checks, so inconsistent
+    # inputs must be rejected before they are evaluated.
+    for problem, nodes in problems():
+        weights = trial_weights(nodes, 2)
+        for bad_weights in [weights[:-1], np.vstack((weights, weights))]:
+            with pytest.raises(ValueError):
+                problem.residuals(nodes, bad_weights)
+            with pytest.raises(ValueError):
+                problem.jacobian(nodes, bad_weights)
+
+def test_quasi_newton():
+    problem = GinzburgLandauFlatInterface(-0.25, 0.25, 1)
+    nodes = problem.numerical_domain_size * np.linspace(-1, 1, 41)**3
+    guess = np.stack((np.tanh(nodes/1.5), 0.5/np.cosh(nodes)**2), axis=1)
+
+    newton = problem.solve(nodes, guess.copy(), exceed_max_iters='raise')
+    quasi_newton = problem.solve(nodes, guess.copy(), refactor_interval=2,
+                                 max_newton_iters=60, exceed_max_iters='raise')
+    assert np.allclose(quasi_newton, newton, atol=1e-6)
+
+    with pytest.raises(ValueError):
+        problem.solve(nodes, guess.copy(), refactor_interval=0)
+
+@pytest.mark.parametrize('order', [1, 2])
+def test_solve(order):
+    problem = HeatEquation()
+    nodes = np.linspace(0, 1, 11)
+    solution = problem.solve(nodes, np.zeros((len(nodes), order)), exceed_max_iters='raise')
+    assert np.allclose(solution[:,0], problem.exact_solution(nodes), atol=1e-12)
+
+    # Nodes are placed exactly on the boundary conditions at the edges and centre of the domain.
+    problem = GinzburgLandauFlatInterface(-0.25, 0.25, 1)
+    nodes = problem.numerical_domain_size * np.linspace(-1, 1, 41)**3
+    guess = np.zeros((len(nodes), order))
+    guess[:,0] = np.sign(nodes)
+    solution = problem.solve(nodes, guess, max_newton_iters=50, exceed_max_iters='raise')
+    tolerance = {1: 5e-3, 2: 1e-4}[order]
+    assert np.allclose(solution[:,0], problem.exact_solution(nodes), atol=tolerance)